@@ -7,11 +7,17 @@
 # ===============================================
 
 import os
+import re
+import sys
+import pickle
+import hashlib
+import multiprocessing
+import numpy as np
 import pandas as pd
 import ufal.udpipe
-import re
 import matplotlib.pyplot as plt
 from collections import defaultdict, Counter
+from itertools import compress, islice
 
 # ----------------------------
 # Nastaveni cest a modelu
@@ -23,11 +29,23 @@ SLOZKY_ANALYZA = []
 CSTA_NRC = 'Czech-NRC-EmoLex.txt'
 CSTA_MODELU = 'czech-pdt-ud-2.5-191206.udpipe'
 
+# Uložený načtený slovník NRC ({hash} = otisk souboru slovníku). Verzi v názvu
+# je třeba zvýšit při každé změně funkce nacti_nrc, jinak by se načetla stará cache.
+CSTA_NRC_CACHE = 'nrc_cache_analyza_v1_{hash}.pkl'
+
+# Počet paralelních procesů (každý si načte vlastní model UDPipe)
+POCET_PROCESU = os.cpu_count() or 1
+
 # Seznam slov ze slovniku, ktere nenesou žádnou emoci
 IGNOROVAT_SLOVA = {}
 
 # Emoce k ignorovani pro konkretni slova, např. 'dobrý': {'fear'}
 IGNOROVAT_EMOCE_PRO_SLOVO = {}
+# Převod na frozensety internovaných řetězců (stejný tvar jako hodnoty slovníku NRC)
+IGNOROVAT_EMOCE_PRO_SLOVO = {w: frozenset(sys.intern(e) for e in emos) for w, emos in IGNOROVAT_EMOCE_PRO_SLOVO.items()}
+
+# Prázdná množina emocí pro slova bez výjimek
+ZADNE_EMOCE = frozenset()
 
 # Barvy pro grafy, např. 'Bankéři': 'blue'
 BARVY = {}
@@ -53,15 +71,61 @@ PREKLAD_EMOCI = {
 # Načtení slovníku
 def nacti_nrc(cesta):
     df = pd.read_csv(cesta, sep='\t')
-    slovnik = defaultdict(set)         
     emoce = ['anger','anticipation','disgust','fear',
              'joy','negative','positive','sadness',
              'surprise','trust']
-    for _, row in df.iterrows():
-        w = row['Czech Word'].strip().lower()
-        for emo in emoce:
-            if row[emo] == 1:
-                slovnik[w].add(emo)     
+    slova = df['Czech Word'].str.strip().str.lower()
+    # Jedno české slovo může být v lexikonu vícekrát (překlad více anglických slov),
+    # jeho emoce se proto sjednotí přes všechny řádky najednou
+    maska = (df[emoce] == 1).groupby(slova).any()
+    maska = maska[maska.any(axis=1)]
+    emoce = [sys.intern(e) for e in emoce]
+    # Běžný dict s frozensety internovaných řetězců: rychlejší iterace i porovnávání emocí
+    return {w: frozenset(compress(emoce, radek)) for w, radek in zip(maska.index, maska.to_numpy())}
+
+def hash_souboru(cesta):
+    h = hashlib.sha1()
+    with open(cesta, 'rb') as f:
+        for blok in iter(lambda: f.read(1 << 20), b''):
+            h.update(blok)
+    return h.hexdigest()
+
+# Poškozená nebo nečitelná cache se bere jako chybějící (vrací None)
+def nacti_pickle(cesta):
+    try:
+        with open(cesta, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError) as e:
+        print(f"⚠️ Cache '{cesta}' nelze načíst ({e}), vytvoří se znovu.")
+        return None
+
+# Zápis přes dočasný soubor a os.replace, takže přerušený zápis nezanechá poškozený soubor.
+# Cache je jen zrychlení: když ji nejde zapsat (např. složka jen pro čtení), pokračuje se bez ní.
+def uloz_pickle(objekt, cesta):
+    docasny = f'{cesta}.{os.getpid()}.tmp'
+    try:
+        with open(docasny, 'wb') as f:
+            pickle.dump(objekt, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(docasny, cesta)
+    except OSError as e:
+        print(f"⚠️ Cache '{cesta}' nelze uložit ({e}), pokračuji bez ní.")
+        try:
+            os.remove(docasny)
+        except OSError:
+            pass
+
+# Načtení slovníku přes cache na disku: dokud se soubor slovníku nezmění,
+# načte se hotový slovník z pickle místo nového zpracování tabulky
+def nacti_nrc_s_cache(cesta):
+    cesta_cache = CSTA_NRC_CACHE.format(hash=hash_souboru(cesta))
+    slovnik = nacti_pickle(cesta_cache)
+    if isinstance(slovnik, dict):
+        # Internování řetězců se v pickle nezachová, obnoví se zde
+        return {w: frozenset(map(sys.intern, emos)) for w, emos in slovnik.items()}
+    slovnik = nacti_nrc(cesta)
+    uloz_pickle(slovnik, cesta_cache)
     return slovnik
 
 
@@ -72,19 +136,85 @@ def nacti_model(cesta_modelu):
         raise Exception("Nepodarilo se nacist model UDPipe!")
     return model
 
-# Lemmatizace
-def lemmatizuj_vetu(text, model):
-    pipeline = ufal.udpipe.Pipeline(model, 'tokenize', 'tag', 'parse', 'conllu')
-    error = ufal.udpipe.ProcessingError()
-    processed = pipeline.process(text, error)
-    lemmata = []
-    for line in processed.split('\n'):
-        if line and not line.startswith('#'):
-            cols = line.split('\t')
-            if len(cols) > 2:
-                lemma = cols[2]
-                lemmata.append(lemma)
-    return lemmata
+# Sdílený objekt pro chyby UDPipe, vytváří se jen jednou
+CHYBA_UDPIPE = ufal.udpipe.ProcessingError()
+
+# Řádek s tokenem v CoNLL-U: ID, tvar a lemma (třetí sloupec); víceslovné tokeny
+# (ID ve tvaru 1-2) a komentáře se tím přeskočí
+LEMMA_RE = re.compile(r'^\d+\t[^\t]+\t([^\t]+)', re.M)
+
+# Lemmatizace celého textu najednou (pipeline se vytváří jednou pro každý proces).
+# Vstupem jsou věty oddělené novým řádkem, výstupem seznam lemmat pro každou větu.
+# Věty jsou ve výstupu CoNLL-U odděleny prázdným řádkem, lemmata vybírá regulární výraz.
+def lemmatizuj_text(text, pipeline):
+    processed = pipeline.process(text, CHYBA_UDPIPE)
+    if CHYBA_UDPIPE.occurred():
+        raise Exception(f"Chyba UDPipe: {CHYBA_UDPIPE.message}")
+    return [LEMMA_RE.findall(veta) for veta in processed.split('\n\n') if veta.strip()]
+
+# ----------------------------
+# Paralelní zpracování souborů
+# ----------------------------
+
+# Model, pipeline, slovník a případná chyba pracovního procesu (nastaví se v inicializuj_proces)
+pracovni_model = None
+pracovni_pipeline = None
+pracovni_nrc = None
+pracovni_chyba = None
+
+# Spouští se jednou v každém pracovním procesu: model se načte jen jednou na proces,
+# slovník NRC dostane každý proces hotový od hlavního procesu.
+# Výjimku z inicializace by Pool neohlásil (jen by proces donekonečna spouštěl znovu),
+# chyba se proto uloží a vyvolá až v zpracuj_soubor, odkud ji dostane hlavní proces.
+def inicializuj_proces(cesta_modelu, nrc_slovnik):
+    global pracovni_model, pracovni_pipeline, pracovni_nrc, pracovni_chyba
+    pracovni_nrc = nrc_slovnik
+    try:
+        pracovni_model = nacti_model(cesta_modelu)
+        # 'presegmented': každý řádek vstupu je jedna věta, stejně jako při zpracování po řádcích
+        pracovni_pipeline = ufal.udpipe.Pipeline(pracovni_model, 'tokenizer=presegmented', 'tag', 'parse', 'conllu')
+    except Exception as e:
+        pracovni_chyba = e
+
+# Analýza jednoho souboru; vrací četnosti emocí, emoční slova, počet vět
+# a počet vět, ve kterých se jednotlivé emoce vyskytly
+def zpracuj_soubor(cesta):
+    if pracovni_chyba is not None:
+        raise pracovni_chyba
+
+    # Emoční slova se pro celý soubor jen připojují do seznamů podle emocí
+    # a do počítadel se přičtou najednou až na konci
+    zasahy = defaultdict(list)
+    emoce_vet = Counter()
+    celkem_vet = 0
+
+    with open(cesta, 'r', encoding='utf-8') as f:
+        texty = [veta.strip() for veta in f if veta.strip()]
+
+    # Celý soubor projde UDPipe jedním voláním
+    for lemmata in lemmatizuj_text('\n'.join(texty), pracovni_pipeline):
+        aktualni_emoce = set()
+
+        for slovo in lemmata:
+            slovo_ciste = slovo.lower()
+            # Nejdřív nejpřísnější test (slovo je ve slovníku NRC), většina lemmat skončí už tady;
+            # str.isalpha pokrývá celou českou diakritiku a je rychlejší než regulární výraz
+            emos = pracovni_nrc.get(slovo_ciste)
+            if emos is not None and slovo_ciste not in IGNOROVAT_SLOVA and slovo_ciste.isalpha():
+                # Množinové operace nad frozensety místo testu emoce po emoci
+                zakazane = IGNOROVAT_EMOCE_PRO_SLOVO.get(slovo_ciste, ZADNE_EMOCE)
+                if zakazane:
+                    emos = emos - zakazane
+                aktualni_emoce |= emos
+                for emo in emos:
+                    zasahy[emo].append(slovo_ciste)
+
+        celkem_vet += 1
+        emoce_vet.update(aktualni_emoce)
+
+    emoce_counter = Counter({emo: len(slova) for emo, slova in zasahy.items()})
+    slova_podle_emoci = defaultdict(Counter, {emo: Counter(slova) for emo, slova in zasahy.items()})
+    return emoce_counter, slova_podle_emoci, celkem_vet, emoce_vet
 
 # ----------------------------
 # Spuštění analýzy
@@ -92,51 +222,45 @@ def lemmatizuj_vetu(text, model):
 
 if __name__ == '__main__':
     print("\n✅ Načítám NRC slovník...")
-    nrc_slovnik = nacti_nrc(CSTA_NRC)
+    nrc_slovnik = nacti_nrc_s_cache(CSTA_NRC)
 
-    print("\n✅ Načítám UDPipe model...")
-    model = nacti_model(CSTA_MODELU)
+    soubory_slozek = []
+    for slozka in SLOZKY_ANALYZA:
+        print(f"\n\U0001F4C2 Pripravuji analyzu slozky: {slozka}")
+        cesta_slozka = slozka
+        seznam = [os.path.join(cesta_slozka, soubor) for soubor in sorted(os.listdir(cesta_slozka))
+                  if soubor.endswith('.txt')]
+        soubory_slozek.append((slozka, seznam))
+    soubory = [soubor for _, seznam in soubory_slozek for soubor in seznam]
+
+    # Soubory všech složek se zpracují paralelně, nejvýše jeden proces na soubor.
+    # pool.imap zachovává pořadí souborů, takže výsledky (včetně pořadí shodných
+    # četností v most_common) jsou při každém běhu stejné.
+    vysledky_souboru = []
+    if soubory:
+        pocet_procesu = min(POCET_PROCESU, len(soubory))
+        print(f"\n✅ Spouštím {pocet_procesu} procesů (každý načte UDPipe model)...")
+        with multiprocessing.Pool(pocet_procesu, initializer=inicializuj_proces,
+                                  initargs=(CSTA_MODELU, nrc_slovnik)) as pool:
+            vysledky_souboru = list(pool.imap(zpracuj_soubor, soubory))
+    vysledky_souboru = iter(vysledky_souboru)
 
     vysledky_graf = defaultdict(dict)
     celkem_vet_slovnik = {}
 
-    for slozka in SLOZKY_ANALYZA:
-        print(f"\n\U0001F4C2 Pripravuji analyzu slozky: {slozka}")
-
-        cesta_slozka = slozka
+    for slozka, seznam in soubory_slozek:
         emoce_counter = Counter()
         slova_podle_emoci = defaultdict(Counter)
         celkem_vet = 0
 
-        for soubor in os.listdir(cesta_slozka):
-            if soubor.endswith('.txt'):
-                cesta = os.path.join(cesta_slozka, soubor)
-                with open(cesta, 'r', encoding='utf-8') as f:
-                    texty = f.readlines()
-
-                for veta in texty:
-                    veta = veta.strip()
-                    if not veta:
-                        continue
-
-                    lemmata = lemmatizuj_vetu(veta, model)
-
-                    aktualni_emoce = set()
-
-                    for slovo in lemmata:
-                        slovo_ciste = slovo.lower()
-                        if re.match(r'^[a-zá-žÁ-Ž]+$', slovo_ciste) and slovo_ciste not in IGNOROVAT_SLOVA:
-                            if slovo_ciste in nrc_slovnik:
-                                zakazane = IGNOROVAT_EMOCE_PRO_SLOVO.get(slovo_ciste, set())
-                                for emo in nrc_slovnik[slovo_ciste]:
-                                    if emo not in zakazane:
-                                        emoce_counter[emo] += 1
-                                        slova_podle_emoci[emo][slovo_ciste] += 1
-                                        aktualni_emoce.add(emo)
-
-                    celkem_vet += 1
-                    for emo in aktualni_emoce:
-                        vysledky_graf[emo][slozka] = vysledky_graf[emo].get(slozka, 0) + 1
+        # Dílčí výsledky souborů složky se sečtou zde
+        for emoce_souboru, slova_souboru, vet_souboru, emoce_vet in islice(vysledky_souboru, len(seznam)):
+            emoce_counter.update(emoce_souboru)
+            for emo, slova in slova_souboru.items():
+                slova_podle_emoci[emo].update(slova)
+            celkem_vet += vet_souboru
+            for emo, pocet in emoce_vet.items():
+                vysledky_graf[emo][slozka] = vysledky_graf[emo].get(slozka, 0) + pocet
 
         celkem_vet_slovnik[slozka] = celkem_vet
 
@@ -163,21 +287,25 @@ if __name__ == '__main__':
     emoce = sorted(vysledky_graf.keys())
     slozky = SLOZKY_ANALYZA
 
-    data = {slozka: [vysledky_graf[emo].get(slozka, 0) for emo in emoce] for slozka in slozky}
-    total = celkem_vet_slovnik
+    # Matice složky × emoce, normalizovaná počtem vět ve složce jednou operací
+    data = np.array([[vysledky_graf[emo].get(slozka, 0) for emo in emoce] for slozka in slozky],
+                    dtype=float).reshape(len(slozky), len(emoce))
+    total = np.array([celkem_vet_slovnik[slozka] for slozka in slozky], dtype=float)
+    podily = np.divide(data, total[:, None], out=np.zeros_like(data), where=total[:, None] > 0)
 
-    x = range(len(emoce))
+    x = np.arange(len(emoce))
     bar_width = 0.2
 
     center_offset = bar_width * (len(slozky) - 1) / 2
 
+    # Složky bez vlastní barvy v BARVY dostanou barvu z palety tab10
+    paleta = plt.get_cmap('tab10')
+
     plt.figure(figsize=(14, 6))
     for i, slozka in enumerate(slozky):
-        positions = [val + bar_width * i for val in x]
-        y = [data[slozka][j] / total[slozka] if total[slozka] > 0 else 0 for j in range(len(emoce))]
-        plt.bar(positions, y, width=bar_width, label=slozka, color=BARVY[slozka])
+        plt.bar(x + bar_width * i, podily[i], width=bar_width, label=slozka, color=BARVY.get(slozka, paleta(i % paleta.N)))
 
-    plt.xticks([val + center_offset for val in x], [PREKLAD_EMOCI.get(emo, emo) for emo in emoce], rotation=45, fontsize=16)
+    plt.xticks(x + center_offset, [PREKLAD_EMOCI.get(emo, emo) for emo in emoce], rotation=45, fontsize=16)
     plt.legend()
     plt.tight_layout()
     plt.show()
\ No newline at end of file
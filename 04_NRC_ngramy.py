@@ -7,12 +7,24 @@
 # ===============================================
 
 import os
+import sys
 import re
-import csv
+import pickle
+import hashlib
+import multiprocessing
 import ufal.udpipe
+import numpy as np
 import pandas as pd
 from collections import defaultdict, Counter
-from itertools import islice
+from itertools import islice, compress
+
+# Numba je volitelná: pokud není nainstalovaná, n-gramy se počítají v čistém Pythonu
+try:
+    import numba
+    from numba import types
+    from numba.typed import Dict
+except ImportError:
+    numba = None
 
 # ----------------------------
 # Konfigurace
@@ -24,6 +36,27 @@ FOLDER = ''
 CSTA_NRC   = 'Czech-NRC-EmoLex.txt'
 CSTA_MODEL = 'czech-pdt-ud-2.5-191206.udpipe'
 
+# Počet segmentů zpracovaných UDPipe v jednom volání
+BATCH_SIZE = 2000
+
+# Počet paralelních procesů pro UDPipe (každý si načte vlastní model)
+N_PROCESSES = os.cpu_count() or 1
+
+# Nastavení nejnižšího počtu výskytu: n-gram se dostane do tabulky, pokud se
+# u některé emoce vyskytne víc než MIN_COUNT-krát
+MIN_COUNT = 6
+
+# Uložený načtený slovník NRC ({hash} = otisk souboru slovníku). Verzi v názvu
+# je třeba zvýšit při každé změně funkce read_nrc, jinak by se načetla stará cache.
+CSTA_NRC_CACHE = 'nrc_cache_ngramy_v1_{hash}.pkl'
+
+# Soubor s uloženými výsledky lemmatizace ({hash} = otisk souboru modelu). Verzi v názvu
+# je třeba zvýšit při změně nastavení pipeline UDPipe nebo výstupu lemmatize_segments.
+CSTA_LEMMA_CACHE = 'lemma_cache_v1_{hash}.pkl'
+
+# Nejvyšší počet segmentů v cache lemmatizace; nad tento počet se zahodí nejdéle nepoužité
+LEMMA_CACHE_MAX = 500000
+
 # ----------------------------
 # Stop-slovníky
 # ----------------------------
@@ -33,6 +66,8 @@ CSTA_MODEL = 'czech-pdt-ud-2.5-191206.udpipe'
 IGNOROVAT_SLOVA_NRC = {}
 # Emoce, které ignorujeme pro konkrétní slova
 IGNOROVAT_EMOCE_PRO_SLOVO = {}
+# Převod na frozensety internovaných řetězců (stejný tvar jako hodnoty slovníku NRC)
+IGNOROVAT_EMOCE_PRO_SLOVO = {w: frozenset(sys.intern(e) for e in emos) for w, emos in IGNOROVAT_EMOCE_PRO_SLOVO.items()}
 
 # Seznam slov, které nenesou důležitý význam a budou vyřazeny z výsledků, např. zájmena, spojky atd.
 STOPWORDS_NGRAM = {}
@@ -40,17 +75,31 @@ STOPWORDS_NGRAM = {}
 # ----------------------------
 # Načtení NRC lexikonu
 # ----------------------------
+def read_nrc(path):
+    # Vše jako text bez převodu na NaN, stejně jako při čtení přes csv; hodnoty emocí jsou '0'/'1'
+    df=pd.read_csv(path,sep='\t',dtype=str,keep_default_na=False)
+    emo_cols=[c for c in df.columns if c not in('English Word','Czech Word')]
+    words=df['Czech Word'].str.strip().str.lower()
+    # Emoce se sjednotí přes všechny řádky se stejným českým slovem najednou
+    mask=pd.DataFrame(df[emo_cols].to_numpy()=='1',columns=emo_cols).groupby(words.to_numpy()).any()
+    mask=mask[mask.any(axis=1)]
+    emos=[sys.intern(e.lower()) for e in emo_cols]
+    # Běžný dict s frozensety internovaných řetězců emocí
+    return {w:frozenset(compress(emos,r)) for w,r in zip(mask.index,mask.to_numpy())
+            if w}
+
+# Slovník se po prvním zpracování uloží do pickle podle otisku souboru.
+# Stop-slova IGNOROVAT_SLOVA_NRC se odfiltrují až po načtení, aby cache nezávisela na nastavení.
 def load_nrc(path):
-    slovnik=defaultdict(set)
-    with open(path,encoding='utf-8') as f:
-        reader=csv.DictReader(f,delimiter='\t')
-        emo_cols=[c for c in reader.fieldnames if c not in('English Word','Czech Word')]
-        for row in reader:
-            w=row['Czech Word'].strip().lower()
-            if not w or w in IGNOROVAT_SLOVA_NRC: continue
-            for emo in emo_cols:
-                if row.get(emo)=='1': slovnik[w].add(emo.lower())
-    return slovnik
+    cache_path=CSTA_NRC_CACHE.format(hash=file_hash(path))
+    slovnik=load_pickle(cache_path)
+    if isinstance(slovnik,dict):
+        # Internování řetězců se v pickle nezachová, obnoví se zde
+        slovnik={w:frozenset(map(sys.intern,emos)) for w,emos in slovnik.items()}
+    else:
+        slovnik=read_nrc(path)
+        save_pickle(slovnik,cache_path)
+    return {w:emos for w,emos in slovnik.items() if w not in IGNOROVAT_SLOVA_NRC}
 
 # ----------------------------
 # UDPipe a lemmatizace
@@ -60,31 +109,180 @@ def load_udpipe_model(path):
     if not model: raise Exception("Nepodařilo se načíst UDPipe model!")
     return model
 
-def lemmatize_sentence(sent,model):
-    pipeline=ufal.udpipe.Pipeline(model,'tokenize','tag','parse','conllu')
-    err=ufal.udpipe.ProcessingError()
-    out=pipeline.process(sent,err)
-    lem = []
-    for line in out.split('\n'):
-        if not line or line.startswith('#'):
-            continue
-        parts = line.split('\t')
-        if len(parts) <= 3:
-            continue
-        lemma = parts[2].lower()
-        upos = parts[3]  # ← TADY doplněno
+# Jeden sdílený objekt pro chyby; pipeline se vytváří jednou pro každý proces
+UDPIPE_ERR=ufal.udpipe.ProcessingError()
+
+# Řádek s tokenem v CoNLL-U: ID, tvar, lemma a UPOS; víceslovné tokeny (ID 1-2)
+# a komentáře se tím přeskočí
+LEMMA_RE=re.compile(r'^\d+\t[^\t]+\t([^\t]+)\t([^\t]+)',re.M)
+
+# Lemmatizace celé dávky segmentů jedním voláním UDPipe. Pipeline je vytvořena
+# s 'tokenizer=presegmented', takže každý řádek vstupu odpovídá jedné větě výstupu.
+# Pro každý segment vrací n-tici dvojic (lemma, upos), zatím bez filtrování stop-slov.
+def lemmatize_segments(segs,pipeline):
+    out=pipeline.process('\n'.join(segs),UDPIPE_ERR)
+    if UDPIPE_ERR.occurred(): raise Exception(f"Chyba UDPipe: {UDPIPE_ERR.message}")
+    # Věty jsou odděleny prázdným řádkem
+    return [tuple((lemma.lower(),upos) for lemma,upos in LEMMA_RE.findall(sent))
+            for sent in out.split('\n\n') if sent.strip()]
 
+# Odstranění stop-slov z lemmat segmentu (číslovky se ponechávají vždy)
+def filter_lemmas(lemmas):
+    lem = []
+    for lemma, upos in lemmas:
         if upos == 'NUM' or lemma.isdigit():
             lem.append(lemma)
         elif lemma not in STOPWORDS_NGRAM:
             lem.append(lemma)
     return lem
 
+# ----------------------------
+# Cache lemmatizace
+# ----------------------------
+def file_hash(path):
+    h=hashlib.sha1()
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+# Cache je slovník segment -> lemmata; soubor je pojmenován podle otisku modelu,
+# takže výsledky jiného modelu se nikdy nepoužijí
+def lemma_cache_path(model_path):
+    return CSTA_LEMMA_CACHE.format(hash=file_hash(model_path))
+
+# Poškozená nebo nečitelná cache se bere jako chybějící (vrací None)
+def load_pickle(path):
+    try:
+        with open(path,'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError,pickle.UnpicklingError,EOFError) as e:
+        print(f"Cache '{path}' nelze načíst ({e}), vytvoří se znovu.")
+        return None
+
+# Zápis přes dočasný soubor a os.replace, takže přerušený zápis nezanechá poškozený soubor.
+# Cache je jen zrychlení: když ji nejde zapsat (např. složka jen pro čtení), pokračuje se bez ní.
+def save_pickle(obj,path):
+    tmp=f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp,'wb') as f:
+            pickle.dump(obj,f,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp,path)
+    except OSError as e:
+        print(f"Cache '{path}' nelze uložit ({e}), pokračuji bez ní.")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+def load_lemma_cache(path):
+    cache=load_pickle(path)
+    return cache if isinstance(cache,dict) else {}
+
+# Segmenty jsou v cache seřazené od nejdéle nepoužitého (viz lemmatize_cached),
+# nad LEMMA_CACHE_MAX se uloží jen ty naposledy použité
+def save_lemma_cache(cache,path):
+    if len(cache)>LEMMA_CACHE_MAX:
+        cache=dict(islice(cache.items(),len(cache)-LEMMA_CACHE_MAX,None))
+    save_pickle(cache,path)
+
+# 'presegmented': každý řádek vstupu je samostatná věta
+def make_pipeline(model):
+    return ufal.udpipe.Pipeline(model,'tokenizer=presegmented','tag','parse','conllu')
+
+# Model, pipeline a případná chyba načtení v pracovním procesu (nastaví se v init_worker)
+worker_model=None
+worker_pipeline=None
+worker_error=None
+
+# Spouští se jednou v každém pracovním procesu, model se tak načte jen jednou na proces.
+# Výjimku z inicializace Pool neohlásí (jen proces donekonečna spouští znovu), proto se
+# chyba uloží a vyvolá se až v lemmatize_batch, odkud ji dostane hlavní proces.
+def init_worker(model_path):
+    global worker_model,worker_pipeline,worker_error
+    try:
+        worker_model=load_udpipe_model(model_path)
+        worker_pipeline=make_pipeline(worker_model)
+    except Exception as e:
+        worker_error=e
+
+def lemmatize_batch(batch):
+    if worker_error is not None:
+        raise worker_error
+    return lemmatize_segments(batch,worker_pipeline)
+
+# Lemmatizace se zapamatováním: do UDPipe jde každý segment, který v cache ještě není,
+# právě jednou (i když se v textu opakuje). Více dávek se zpracuje paralelně, nejvýše
+# jeden proces na dávku; jediná dávka se zpracuje přímo v hlavním procesu. Pokud je vše
+# v cache, model se vůbec nenačítá.
+def lemmatize_cached(segs,model_path,cache):
+    missing=list(dict.fromkeys(seg for seg in segs if seg not in cache))
+    if missing:
+        batches=[missing[start:start+BATCH_SIZE] for start in range(0,len(missing),BATCH_SIZE)]
+        n_processes=min(N_PROCESSES,len(batches))
+        if n_processes==1:
+            print(f"Lemmatizuji {len(missing)} nových segmentů…")
+            # Pipeline si model sama nedrží, model proto musí žít po celou dobu jejího použití
+            model=load_udpipe_model(model_path)
+            pipeline=make_pipeline(model)
+            results=(lemmatize_segments(batch,pipeline) for batch in batches)
+            store_batches(batches,results,cache)
+        else:
+            print(f"Lemmatizuji {len(missing)} nových segmentů ({n_processes} procesů)…")
+            with multiprocessing.Pool(n_processes,initializer=init_worker,initargs=(model_path,)) as pool:
+                store_batches(batches,pool.imap(lemmatize_batch,batches),cache)
+    # Použité segmenty se přesunou na konec cache, na začátku zůstanou nejdéle nepoužité
+    for seg in dict.fromkeys(segs):
+        cache[seg]=cache.pop(seg)
+    return [cache[seg] for seg in segs]
+
+def store_batches(batches,results,cache):
+    for batch,lems in zip(batches,results):
+        if len(lems)!=len(batch):
+            raise Exception("UDPipe vrátil jiný počet vět, než kolik segmentů dostal!")
+        cache.update(zip(batch,lems))
+
 # ----------------------------
 # N-gramy
 # ----------------------------
 def ngrams(tokens,n): return zip(*(islice(tokens,i,None) for i in range(n)))
 
+# N-gram z id tokenů se kóduje do jednoho int64 jako a*N*N + b*N + c (N = NGRAM_BASE),
+# trigram se tak vejde do 63 bitů pro slovník až 2^21 různých tokenů
+NGRAM_BASE = 1 << 21
+
+if numba is not None:
+    # Jedno volání pro všechny segmenty emoce: ids jsou id tokenů všech segmentů za sebou,
+    # segment s začíná na starts[s] a končí před starts[s + 1]. N-gramy nepřekračují
+    # hranice segmentů. Vrací pole klíčů n-gramů a jejich četností.
+    @numba.njit(cache=True)
+    def count_ngrams(ids, starts, n):
+        out = Dict.empty(types.int64, types.int64)
+        for s in range(len(starts) - 1):
+            for i in range(starts[s], starts[s + 1] - n + 1):
+                key = 0
+                for j in range(n):
+                    key = key * NGRAM_BASE + ids[i + j]
+                out[key] = out.get(key, 0) + 1
+        keys = np.empty(len(out), dtype=np.int64)
+        vals = np.empty(len(out), dtype=np.int64)
+        k = 0
+        for key, val in out.items():
+            keys[k] = key
+            vals[k] = val
+            k += 1
+        return keys, vals
+
+# Převod pole klíčů n-gramů zpět na řetězce (id tokenů se z klíče vybírají po řádech)
+def decode_ngrams(keys,n,id2token):
+    parts=[]
+    for _ in range(n):
+        keys,tok=np.divmod(keys,NGRAM_BASE)
+        parts.append(tok.tolist())
+    return [' '.join(map(id2token.__getitem__,reversed(toks))) for toks in zip(*parts)]
+
 # ----------------------------
 # Čtení vět
 # ----------------------------
@@ -99,26 +297,86 @@ def read_sentences(folder):
 # ----------------------------
 # Výpočet n-gramů podle emocí
 # ----------------------------
-def top_ngrams_by_emotion(nrc, model, sents, stopw, emo_filter):
-    uni = defaultdict(Counter)
-    bi = defaultdict(Counter)
-    tri = defaultdict(Counter)
-
-    for sent in sents:
-        segments = re.split(r'[.,?!\-]', sent)
-        for seg in segments:
-            seg = seg.strip()
-            if not seg:
-                continue
-            lem = lemmatize_sentence(seg, model)
-            emos = {e for tok in lem for e in nrc.get(tok, []) if e not in emo_filter.get(tok, set())}
+
+# Interpunkce, podle které se věty dělí na segmenty
+SEG_RE = re.compile(r'[.,?!\-]')
+
+# Pro každý segment vrací dvojici (emoce segmentu, tokeny pro n-gramy)
+def emotion_segments(nrc, lemmas_seq, stopw, emo_filter):
+    for lemmas in lemmas_seq:
+        lem = filter_lemmas(lemmas)
+        emos = {e for tok in lem for e in nrc.get(tok, []) if e not in emo_filter.get(tok, set())}
+        if emos:
             toks = [t for t in lem if t.isalpha() and t not in stopw]
-            for e in emos:
-                uni[e].update(toks)
-                for bg in ngrams(toks, 2):
-                    bi[e][' '.join(bg)] += 1
-                for tg in ngrams(toks, 3):
-                    tri[e][' '.join(tg)] += 1
+            yield emos, toks
+
+# Varianta v čistém Pythonu. Každý token se zahashuje jen jednou (převod na id),
+# pro každou emoci se id jen připojí do seznamu a sečtou se až na konci přes np.bincount
+def count_by_emotion_python(items):
+    token2id = {}
+    uni_ids = defaultdict(list)
+    bi_ids = defaultdict(Counter)
+    tri_ids = defaultdict(Counter)
+    for emos, toks in items:
+        ids = [token2id.setdefault(t, len(token2id)) for t in toks]
+        # Bigramy a trigramy jsou n-tice id tokenů; na text se převedou až na konci.
+        # Sestaví se jednou za segment a pro každou emoci se jen sečtou (Counter.update v C)
+        seg_bi = list(ngrams(ids, 2))
+        seg_tri = list(ngrams(ids, 3))
+        for e in emos:
+            uni_ids[e].extend(ids)
+            bi_ids[e].update(seg_bi)
+            tri_ids[e].update(seg_tri)
+
+    id2token = list(token2id)
+    uni = {}
+    for e, ids in uni_ids.items():
+        counts = np.bincount(np.asarray(ids, dtype=np.int64), minlength=len(id2token)).tolist()
+        uni[e] = Counter({id2token[i]: c for i, c in enumerate(counts) if c})
+    bi = {e: Counter({' '.join(map(id2token.__getitem__, k)): c for k, c in ctr.items()}) for e, ctr in bi_ids.items()}
+    tri = {e: Counter({' '.join(map(id2token.__getitem__, k)): c for k, c in ctr.items()}) for e, ctr in tri_ids.items()}
+    return uni, bi, tri
+
+# Varianta s Numbou: tokeny se převedou na celočíselná id, která se pro každou emoci
+# jen připojí do jednoho pole (spolu s délkami segmentů). Kompilovaná smyčka se pak volá
+# jednou pro každou emoci a délku n-gramu, ne pro každý segment zvlášť.
+def count_by_emotion_numba(items):
+    token2id = {}
+    emo_ids = defaultdict(list)
+    emo_lens = defaultdict(list)
+    for emos, toks in items:
+        ids = [token2id.setdefault(t, len(token2id)) for t in toks]
+        for e in emos:
+            emo_ids[e].extend(ids)
+            emo_lens[e].append(len(ids))
+    if len(token2id) > NGRAM_BASE:
+        raise Exception("Příliš mnoho různých tokenů pro kódování n-gramů!")
+
+    id2token = list(token2id)
+    uni, bi, tri = {}, {}, {}
+    for e, ids in emo_ids.items():
+        ids = np.asarray(ids, dtype=np.int64)
+        starts = np.zeros(len(emo_lens[e]) + 1, dtype=np.int64)
+        np.cumsum(emo_lens[e], out=starts[1:])
+        counts = np.bincount(ids, minlength=len(id2token)).tolist()
+        uni[e] = Counter({id2token[i]: c for i, c in enumerate(counts) if c})
+        for n, res in ((2, bi), (3, tri)):
+            keys, vals = count_ngrams(ids, starts, n)
+            res[e] = Counter(dict(zip(decode_ngrams(keys, n, id2token), vals.tolist())))
+    return uni, bi, tri
+
+def top_ngrams_by_emotion(nrc, model_path, sents, stopw, emo_filter, cache=None):
+    if cache is None:
+        cache = {}
+
+    segments = [seg for sent in sents for seg in filter(None, map(str.strip, SEG_RE.split(sent)))]
+
+    # Segmenty jdou do UDPipe po dávkách; opakované segmenty se berou z cache
+    items = emotion_segments(nrc, lemmatize_cached(segments, model_path, cache), stopw, emo_filter)
+    if numba is not None:
+        uni, bi, tri = count_by_emotion_numba(items)
+    else:
+        uni, bi, tri = count_by_emotion_python(items)
 
     return {
         'unigrams_raw': uni,
@@ -132,45 +390,51 @@ def top_ngrams_by_emotion(nrc, model, sents, stopw, emo_filter):
 if __name__ == '__main__':
     print(f"Načítám NRC z '{CSTA_NRC}'…")
     nrc = load_nrc(CSTA_NRC)
-    print(f"Načítám UDPipe model z '{CSTA_MODEL}'…")
-    model = load_udpipe_model(CSTA_MODEL)
     print(f"Načítám věty ze složky '{FOLDER}'…")
     sents = read_sentences(FOLDER)
     print(f"Počet vět: {len(sents)}")
 
-    results = top_ngrams_by_emotion(nrc, model, sents, STOPWORDS_NGRAM, IGNOROVAT_EMOCE_PRO_SLOVO)
+    cache_path = lemma_cache_path(CSTA_MODEL)
+    lemma_cache = load_lemma_cache(cache_path)
+    print(f"Lemmat v cache: {len(lemma_cache)}")
+
+    results = top_ngrams_by_emotion(nrc, CSTA_MODEL, sents, STOPWORDS_NGRAM, IGNOROVAT_EMOCE_PRO_SLOVO, lemma_cache)
 
     # Vytvoření matice emoce × n-gramy ze všech (uni + bi + tri)
-    all_raw = defaultdict(Counter)
-    for level in ['unigrams_raw', 'bigrams_raw', 'trigrams_raw']:
-        for emo, ctr in results[level].items():
-            all_raw[emo].update(ctr)
+    levels = [results[level] for level in ['unigrams_raw', 'bigrams_raw', 'trigrams_raw']]
+    cols = sorted({w for level in levels for counter in level.values() for w, c in counter.items() if c > MIN_COUNT})
+
+    # Řídké n-gramy se zahodí hned, do matice se přenesou jen n-gramy ze sloupců
+    col_set = set(cols)
+    all_raw = defaultdict(dict)
+    for level in levels:
+        for emo, ctr in level.items():
+            all_raw[emo].update((w, c) for w, c in ctr.items() if w in col_set)
+    del results, levels
 
-    cols = sorted({w for emo, counter in all_raw.items() for w, c in counter.items() if c > 6}) #Nastavení nejnižšího počtu výskytu
     pos = ['positive', 'joy', 'anticipation', 'surprise', 'trust']
     neg = ['negative', 'anger', 'sadness', 'disgust', 'fear']
     rows = [e for e in pos + neg if e in all_raw]
-    df = pd.DataFrame(0, index=rows, columns=cols)
-    for emo in rows:
-        counter = all_raw.get(emo, Counter())
-        for w in cols:
-            df.at[emo, w] = counter.get(w, 0)
+    # Matice se sestaví najednou z řádků četností místo zápisu po jednotlivých buňkách
+    df = pd.DataFrame([[all_raw[emo].get(w, 0) for w in cols] for emo in rows],
+                      index=rows, columns=cols, dtype=int)
 
     # Styling a zápis do HTML
+    # Styly se počítají pro celou matici najednou (broadcasting a np.char místo smyčky přes buňky)
     def highlight(df):
-        sty = pd.DataFrame('', index=df.index, columns=df.columns)
-        maxv = df.values.max() or 1
-        for emo in df.index:
-            color = '0,128,0' if emo in pos else '255,0,0'
-            for w in df.columns:
-                v = df.at[emo, w]
-                if v > 0:
-                    alpha = v / maxv
-                    sty.at[emo, w] = f'background-color: rgba({color},{alpha});'
-        return sty
+        vals = df.to_numpy()
+        maxv = vals.max() or 1
+        colors = np.where(df.index.isin(pos), '0,128,0', '255,0,0')[:, None]
+        alpha = (vals / maxv).astype(str)
+        sty = np.char.add(np.char.add('background-color: rgba(', colors), np.char.add(',', alpha))
+        sty = np.char.add(sty, ');')
+        return pd.DataFrame(np.where(vals > 0, sty, ''), index=df.index, columns=df.columns)
 
     styled = df.style.apply(highlight, axis=None)
     html = styled.to_html()
     with open('emocni_matice.html', 'w', encoding='utf-8') as f:
         f.write(html)
     print("✅ Vytvořena tabulka emocí ze všech n-gramů (uloženo jako 'emocni_matice.html')")
+
+    # Cache lemmatizace se ukládá až po zápisu výsledků
+    save_lemma_cache(lemma_cache, cache_path)